@@ -21,12 +21,13 @@ from rpkm_correlate import correlateRPKM
 from os import listdir
 from os.path import join
 
-# Generate the list of pathway info files to work with
-pwy_files = [join('data/pwy/', f) for f in listdir('data/pwy/')]
+# Each pair of files is independent of the others, so they can be correlated in parallel worker processes
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 
-# Iterate through and correlate all of the relevant files
-for file in pwy_files:
+def correlatePathwayFile(file):
+	""" correlatePathwayFile(): Correlates a single pathway info file (in data/pwy/) with its ORF data file (in data/orf/), putting the output in data/out/ """
+
 	# Generate the name of the ORF data file that corresponds to the input PWY file
 	orf_name = file.replace('.pwy.txt', '.orf_rpkm.txt').replace('data/pwy/','data/orf/')
 
@@ -37,3 +38,17 @@ for file in pwy_files:
 
 	# Correlate the data and output it. 
 	correlateRPKM(file, orf_name, out_name)
+
+
+# Only generate and dispatch the work from the main process (worker processes may re-import this file)
+if __name__ == "__main__":
+	# Generate the list of pathway info files to work with
+	pwy_files = [join('data/pwy/', f) for f in listdir('data/pwy/')]
+
+	# Correlate all of the relevant files, one worker process per CPU core
+	with ProcessPoolExecutor() as executor:
+		futures = [executor.submit(correlatePathwayFile, file) for file in pwy_files]
+
+		# Wait for each correlation to finish (re-raising any error that occurred in a worker)
+		for future in as_completed(futures):
+			future.result()
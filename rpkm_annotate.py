@@ -7,23 +7,36 @@ __license__ = "CC0 - No rights reserved. See LICENSE"
 import csv
 import sys
 
-from os import listdir
-from os.path import join
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from os import remove, replace, scandir
 
-from rpkm_correlate import loadPathwayInfoFromFile, loadORFDataFromFile, correlatePathwayInfoWithData
+from rpkm_correlate import loadPathwayInfoFromFile, loadORFDataFromFile, loadCachedData, storeCachedData
 
 
-def loadAnnotationsFromFile(filename, sample_name, csv_separator):
+def loadAnnotationsFromFile(filename, sample_name, csv_separator, use_cache=False):
 	""" loadAnnotationsFromFile(): 	Loads ORF annotations from a specified file and returns the relevant fields for each ORF
 
 									Parameters:
 									- filename: name of the file to load annotations from
 									- sample_name: name of the sample these annotations are for (to properly format the IDs)
 									- csv_separator: column separator used in given file
+									- use_cache: whether to reuse (and store) the parsed annotations in a cache file alongside the annotation file
 
 									Returns: a tuple - (name of sample, dict of tuples of annotation data indexed by ORF ID) """
 
+	# If caching is enabled and this file has already been parsed (for this sample), reuse the cached annotations
+	if use_cache:
+		cached_data = loadCachedData(filename, (sample_name, csv_separator))
+		if cached_data is not None:
+			return cached_data
+
 	anno_data=(sample_name, {})
+	anno_data_dict = anno_data[1] # Dict of annotation data, keyed by ORF ID
+
+	# ORF IDs that include the sample name are formatted as [Sample Name]_###_## - strip that prefix with a single slice where possible
+	id_prefix = sample_name + '_'
+	id_prefix_len = len(id_prefix)
 
 	try:
 		# Load the specified annotations file
@@ -36,13 +49,15 @@ def loadAnnotationsFromFile(filename, sample_name, csv_separator):
 					continue
 
 				 # Generate the proper corresponding ORF ID - if the sample name is part of the ID, remove it.
-				if sample_name in row[0]:
+				if row[0].startswith(id_prefix):
+					anno_query = 'O_' + row[0][id_prefix_len:]
+				elif sample_name in row[0]:
 					anno_query = 'O_' + row[0].replace(sample_name,'')[1:]
 				else:
 					anno_query = 'O_' + row[0]
 
 				# Only take the first annotation result from each ORF
-				if anno_query in anno_data[1]:
+				if anno_query in anno_data_dict:
 					continue
 
 				anno_hit = row[9].split('[')[0] # Grab only the name of the gene as the 'hit'
@@ -54,7 +69,7 @@ def loadAnnotationsFromFile(filename, sample_name, csv_separator):
 				anno_ec = row[8] 		# 'ec' column
 
 				# Store the loaded data in the dict in anno_data, which is keyed by the ORF ID
-				anno_data[1][anno_query] = (anno_hit, anno_q_length, anno_bitscore, anno_bsr, anno_expect, anno_identity, anno_ec)
+				anno_data_dict[anno_query] = (anno_hit, anno_q_length, anno_bitscore, anno_bsr, anno_expect, anno_identity, anno_ec)
 
 	# If an error was encountered loading and processing the annotation file, exit and print the error
 	except Exception as e:
@@ -63,10 +78,124 @@ def loadAnnotationsFromFile(filename, sample_name, csv_separator):
 		quit()
 
 
+	# Store the parsed annotations for later runs, if caching is enabled
+	if use_cache:
+		storeCachedData(filename, (sample_name, csv_separator), anno_data)
+
 	return anno_data
 
 
-def batchCorrelateAnnotate(file_dir, output_filename = 'pwy_anno.tsv', csv_separator='\t', pwy_file_suffix='.pwy.txt', data_file_suffix='.orf_rpkm.txt', anno_file_suffix='.metacyc-2016-10-31.lastout.parsed.txt', selected_pathways=[]):
+def correlateAnnotateSample(pathway_file, data_file, anno_file, csv_separator='\t', selected_pathways=[], use_cache=False):
+	""" correlateAnnotateSample() : 	Load pathway information, RPKM data, and annotation data for a single sample, and match up the relevant annotations and RPKM value for each ORF in each
+									pathway in that sample.
+
+									Parameters:
+									- pathway_file: name of the file containing pathway information for this sample
+									- data_file: name of the file containing RPKM data for this sample
+									- anno_file: name of the file containing annotation data for this sample
+									- csv_separator: column separator used in input files
+									- selected_pathways: list of strings of pathway short names, specifiying which pathways should be included in the output (all pathways if empty)
+									- use_cache: whether to cache the parsed input files alongside them (as <input file>.pkl), so that unchanged files don't need to be parsed again on later runs
+
+									Returns: a tuple - (name of sample, list of output rows, number of pathways processed, number of RPKM data points found, number of annotations found, number of ORFs with no annotations, number of missing RPKM data points) """
+
+	# Produce the output data for this sample
+	output_data = []
+
+	# Keep track of the number of pathways, RPKM data points, and annotations processed for this sample
+	n_total_pathways = 0
+	n_total_datapoints = 0
+	n_total_annotations = 0
+
+	# The loaders print an error and quit() if a file can't be read or parsed - raise an exception instead, so that (when running in a worker process) the main process can stop and exit with an error
+	try:
+		# Load pathway information from the given file
+		pathway_info = loadPathwayInfoFromFile(pathway_file, csv_separator, use_cache)
+		cur_sample = pathway_info[0]
+
+		# Load RPKM data from the file corresponding to the pathway info file (keeping each reading exactly as written, as it is only copied into the output)
+		rpkm_data = loadORFDataFromFile(data_file, cur_sample, csv_separator, use_cache, parse_values=False)
+
+		# Load annotation data from the corresponding file
+		anno_data = loadAnnotationsFromFile(anno_file, cur_sample, csv_separator, use_cache)
+
+	except SystemExit:
+		raise RuntimeError("Could not load sample files for " + pathway_file)
+
+	# The RPKM data and annotation data are already dicts indexed by ORF ID - bind their lookups once, so only the ORFs referenced by the pathways below are ever looked up
+	get_rpkm = rpkm_data[1].get
+	get_anno = anno_data[1].get
+
+	append_row = output_data.append # Bind the append once, rather than resolving it for every output row
+
+	# Keep track of the number of missing annotations and RPKM data points, for troubleshooting.
+	n_missing_annotations = 0
+	n_missing_rpkm = 0
+
+	# Iterate through each pathway
+	for pwy, pwy_cname, pwy_orfs in pathway_info[1]:
+
+		# If a list of selected pathways is selected and this pathway is not in that list, skip it.
+		if len(selected_pathways) > 0 and pwy not in selected_pathways:
+			continue
+
+		n_total_pathways += 1
+
+		# Iterate through each ORF in this pathway
+		for orf in pwy_orfs:
+
+			# Acquire the RPKM reading for this ORF (None if the ORF is not present in the RPKM data loaded for this sample)
+			orf_rpkm = get_rpkm(orf)
+
+			# If the ORF is present in the RPKM data loaded for this sample, continue processing this ORF
+			if orf_rpkm is not None:
+				n_total_datapoints += 1
+
+				# Acquire the annotation data for this ORF (None if there are no annotations for it)
+				orf_anno = get_anno(orf)
+
+				# If the annotation data is present for this ORF, add a new row for this ORF/pathway/sample pair to the output data
+				if orf_anno is not None:
+					n_total_annotations += 1
+
+					# Add a new row to the output data
+					append_row((cur_sample, # SAMPLE
+						pwy,			# PWY_NAME
+						orf,			# ORF
+						orf_anno[0], 	# HIT
+						orf_rpkm, 		# RPKM
+						orf_anno[1], 	# Q_LENGTH
+						orf_anno[2],	# BITSCORE
+						orf_anno[3],	# BSR
+						orf_anno[4],	# EXPECT
+						orf_anno[5],	# IDENTITY
+						orf_anno[6]))	# EC
+
+
+				else: # If the ORF is missing annotation data, output it but indicate that there are no annotations (with zeroes in values etc.)
+					n_missing_annotations += 1
+
+					append_row((cur_sample,
+						pwy,
+						orf,
+						orf,
+						orf_rpkm,
+						0,
+						0,
+						0,
+						0,
+						0,
+						0))
+
+
+			else: # Keep track of missing RPKM data points
+				n_missing_rpkm += 1
+
+	# Return the missing annotation / RPKM data point counts along with the output rows, for the caller to report (rather than printing them here, as this may be running in a worker process)
+	return (cur_sample, output_data, n_total_pathways, n_total_datapoints, n_total_annotations, n_missing_annotations, n_missing_rpkm)
+
+
+def batchCorrelateAnnotate(file_dir, output_filename = 'pwy_anno.tsv', csv_separator='\t', pwy_file_suffix='.pwy.txt', data_file_suffix='.orf_rpkm.txt', anno_file_suffix='.metacyc-2016-10-31.lastout.parsed.txt', selected_pathways=[], use_cache=False, n_workers=None):
 	""" batchCorrelateAnnotate() : 	Load pathway information, RPKM data, and annotation data from separate files in a given directory, and produce an output file showing the relevant annotations and RPKM value
 									for each ORF in each pathway in each sample in the loaded files.
 
@@ -78,37 +207,39 @@ def batchCorrelateAnnotate(file_dir, output_filename = 'pwy_anno.tsv', csv_separ
 									- data_file_suffix: suffix for files containing RPKM data
 									- anno_file_suffix: suffix for files containing annotation data
 									- selected_pathways: list of strings of pathway short names, specifiying which pathways should be included in the output file
+									- use_cache: whether to cache the parsed input files alongside them (as <input file>.pkl), so that unchanged files don't need to be parsed again on later runs
+									- n_workers: number of worker processes to process samples with (defaults to one per CPU core)
 
 									Returns: nothing - outputs results to specified file."""
 
-	# Create a list of all files in the target directory
-	all_files = [join(file_dir, f) for f in listdir(file_dir)]
-
-	# Split the list of all the files into three lists: pathway files, data files, and annotation files
+	# Sort all of the files in the target directory (by suffix) into a list of pathway files, and sets of data files and annotation files (sets, so that matching them up below is a constant-time lookup)
 	pwy_files = []
-	data_files = []
-	anno_files = []
-
-	for file in all_files:
-		if pwy_file_suffix in file:
-			pwy_files.append(file)
-		elif data_file_suffix in file:
-			data_files.append(file)
-		elif anno_file_suffix in file:
-			anno_files.append(file)
-		#else:
-			#print("Unknown file in batch directory: " + file)
+	data_files = set()
+	anno_files = set()
+
+	# Walk the directory in a single pass - scandir() provides each file's name and full path without any further path joining or system calls
+	with scandir(file_dir) as dir_entries:
+		for entry in dir_entries:
+			if entry.name.endswith(pwy_file_suffix):
+				pwy_files.append(entry.path)
+			elif entry.name.endswith(data_file_suffix):
+				data_files.add(entry.path)
+			elif entry.name.endswith(anno_file_suffix):
+				anno_files.add(entry.path)
+			#else:
+				#print("Unknown file in batch directory: " + entry.path)
 
 
 	# Match each pathway information file with its corresponding RPKM data file and annotation file
 	file_pairs = []
 
 	for pwy_file in pwy_files:
-		# Generate the name of the corresponding data file based on the name of the pathway info file
-		corresponding_data_file = pwy_file.replace(pwy_file_suffix, data_file_suffix)
+		# Generate the name of the corresponding data file based on the name of the pathway info file (swapping out the suffix at the end of the name only)
+		file_stem = pwy_file[:-len(pwy_file_suffix)]
+		corresponding_data_file = file_stem + data_file_suffix
 
 		# Generate the name of the corresponding annotation file, using the same technique
-		corresponding_anno_file = pwy_file.replace(pwy_file_suffix, anno_file_suffix)
+		corresponding_anno_file = file_stem + anno_file_suffix
 	
 		# If the necessary files exist, pair them with the pathway file. Otherwise, don't process anything for this set of pathway data.
 		if corresponding_data_file in data_files:
@@ -122,117 +253,64 @@ def batchCorrelateAnnotate(file_dir, output_filename = 'pwy_anno.tsv', csv_separ
 			print("Missing data file: " + corresponding_data_file)
 
 
-	# Produce the output data for this function
-	output_data = []
+	# Generate a header for the output tabulated file 
+	output_file_header = ['SAMPLE', 'PWY_NAME', 'ORF', 'HIT', 'RPKM', 'Q_LENGTH', 'BITSCORE', 'BSR', 'EXPECT', 'IDENTITY', 'EC']
 
 	# Keep track of the total number of pathway/sample pairs, RPKM data points, and annotations loaded
 	n_total_pathways = 0
 	n_total_datapoints = 0
 	n_total_annotations = 0
 
-	for (pathway_file, data_file, anno_file) in file_pairs:
-		# Load pathway information from the given file
-		pathway_info = loadPathwayInfoFromFile(pathway_file, csv_separator)
-		cur_sample = pathway_info[0]
-
-		# Load RPKM data from the file corresponding to the pathway info file
-		rpkm_data = loadORFDataFromFile(data_file, cur_sample, csv_separator)
-
-		# Load annotation data from the corresponding file
-		anno_data = loadAnnotationsFromFile(anno_file, cur_sample, csv_separator)
-
-		# Create a dict from the RPKM data, indexed by ORF ID, for easier searching
-		data_dict = dict(rpkm_data[1])
-
-		# Keep track of the number of missing annotations and RPKM data points, for troubleshooting.
-		n_missing_annotations = 0
-		n_missing_rpkm = 0
-
-		# Iterate through each pathway
-		for pwy, pwy_cname, pwy_orfs in pathway_info[1]:
-
-			# If a list of selected pathways is selected and this pathway is not in that list, skip it.
-			if len(selected_pathways) > 0 and pwy not in selected_pathways:
-				continue
+	# Output the resulting data to a temporary file first, and only move it into place once every sample has been processed - so that a failure part way through never leaves a truncated output file behind
+	tmp_output_filename = output_filename + '.tmp'
 
-			n_total_pathways += 1
+	try:
+		# Each sample's files are independent of the others, so process the samples in parallel (by default, one worker process per CPU core) - results are returned in the same order as file_pairs
+		with ProcessPoolExecutor(max_workers=n_workers) as executor:
+			try:
+				# Write out each sample's rows as soon as they are ready (rather than holding every sample's rows in memory until the end)
+				with open(tmp_output_filename, 'w', newline='', buffering=1<<20) as output_file:
+					output_writer = csv.writer(output_file, delimiter=csv_separator)
 
-			# Iterate through each ORF in this pathway
-			for orf in pwy_orfs:
+					# Write the header to the output file as the first line.
+					output_writer.writerow(output_file_header)
 
-				# If the ORF is present in the RPKM data loaded for this sample, continue processing this ORF
-				if orf in data_dict:
-					n_total_datapoints += 1
+					sample_results = executor.map(partial(correlateAnnotateSample, csv_separator=csv_separator, selected_pathways=selected_pathways, use_cache=use_cache), *zip(*file_pairs))
 
-					# If the annotation data is present for this ORF, add a new row for this ORF/pathway/sample pair to the output data
-					if orf in anno_data[1]:
-						n_total_annotations += 1
+					for (cur_sample, sample_output_data, n_pathways, n_datapoints, n_annotations, n_missing_annotations, n_missing_rpkm) in sample_results:
+						# Report progress from the main process (in file order), rather than having every worker process compete for the console
+						print('Loaded sample: ' + cur_sample + ' - ORFS with no annotations: ' + str(n_missing_annotations) + ' - missing rpkm data points: ' + str(n_missing_rpkm))
 
-						orf_anno = anno_data[1][orf] # Acquire the annotation data for this specific ORF
+						# Write out every row for this sample in a single call (csv.writer still quotes any field containing the separator)
+						output_writer.writerows(sample_output_data)
 
-						# Add a new row to the output data
-						output_data.append((cur_sample, # SAMPLE
-							pwy,			# PWY_NAME
-							orf,			# ORF
-							orf_anno[0], 	# HIT
-							data_dict[orf], # RPKM
-							orf_anno[1], 	# Q_LENGTH
-							orf_anno[2],	# BITSCORE
-							orf_anno[3],	# BSR
-							orf_anno[4],	# EXPECT
-							orf_anno[5],	# IDENTITY
-							orf_anno[6]))	# EC
+						n_total_pathways += n_pathways
+						n_total_datapoints += n_datapoints
+						n_total_annotations += n_annotations
 
+			except BaseException:
+				# Cancel any samples that haven't started processing yet, rather than waiting for all of them before exiting
+				executor.shutdown(wait=False, cancel_futures=True)
+				raise
 
-					else: # If the ORF is missing annotation data, output it but indicate that there are no annotations (with zeroes in values etc.)
-						n_missing_annotations += 1
+		# Every sample was processed successfully - replace the output file with the complete results
+		replace(tmp_output_filename, output_filename)
 
-						output_data.append((cur_sample,
-							pwy,
-							orf,
-							orf,
-							data_dict[orf],
-							0,
-							0,
-							0,
-							0,
-							0,
-							0))
+	except Exception as e: # If an error occurred while processing the samples or writing out the results, remove the partial output and exit with an error.
+		print("ERORR: Processing samples / file output failed - exiting.")
+		print("Exception: " + str(e))
 
+		try:
+			remove(tmp_output_filename)
+		except OSError:
+			pass
 
-				else: # Keep track of missing RPKM data points
-					n_missing_rpkm += 1
+		quit(1)
 
-		print('Loaded sample: ' + cur_sample + ' - ORFS with no annotations: ' + str(n_missing_annotations) + ' - missing rpkm data points: ' + str(n_missing_rpkm))
-				
 
 	print('Processed ' + str(n_total_pathways) + ' sample/pathway pairs, ' + str(n_total_datapoints) + ' RPKM data points, ' + str(n_total_annotations) + ' total annotations.')
 
 
-	
-	# Generate a header for the output tabulated file 
-	output_file_header = ['SAMPLE', 'PWY_NAME', 'ORF', 'HIT', 'RPKM', 'Q_LENGTH', 'BITSCORE', 'BSR', 'EXPECT', 'IDENTITY', 'EC']
-
-
-	# Output the resulting data to the chosen file
-	try:
-		with open(output_filename, 'w') as output_file:
-			output_writer = csv.writer(output_file, delimiter=csv_separator)
-
-			# Write the header to the output file as the first line.
-			output_writer.writerow(output_file_header)
-
-			# Write out each row
-			for row in output_data:
-				output_writer.writerow(row)
-
-	
-	except Exception as e: # If an error occurred while writing out the results, exit.
-		print("ERORR: File output failed - exiting.")
-		print("Exception: " + str(e))
-		quit()
-
-
 
 # Allow the script to be run stand-alone (and prevent the following code from running when imported)
 if __name__ == "__main__":
@@ -265,19 +343,17 @@ if __name__ == "__main__":
 
 	# If --anno-suffix <suffix> is selected, use that as the filename suffix for annotation files
 	if '--anno-suffix' in args:
-		# Acquire the suffix from the command line arguments
-		anno_suffix_idx = args.index('--anno-suffix') + 1
-		anno_suffix = args[anno_suffix_idx]
-		args.remove(anno_suffix)
-		args.remove('--anno-suffix')
+		# Acquire the suffix from the command line arguments, then remove the flag and its value (by position, so no other argument can be removed by mistake)
+		anno_suffix_idx = args.index('--anno-suffix')
+		anno_suffix = args[anno_suffix_idx + 1]
+		del args[anno_suffix_idx:anno_suffix_idx + 2]
 
 	# If --select-pathways <file> is specified, load the list of pathways to process from the specified file
 	if '--select-pathways' in args:
-		# Acquire the specified file name from the command-line arguments
-		select_file_idx = args.index('--select-pathways') + 1
-		pwy_select_filename = args[select_file_idx]
-		args.remove('--select-pathways')
-		args.remove(pwy_select_filename)
+		# Acquire the specified file name from the command-line arguments, then remove the flag and its value (by position, as above)
+		select_file_idx = args.index('--select-pathways')
+		pwy_select_filename = args[select_file_idx + 1]
+		del args[select_file_idx:select_file_idx + 2]
 
 		# Read the names of pathways from the specified file
 		# Currently, the format of the specified file is hardcoded, and must be as such:
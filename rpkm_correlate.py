@@ -5,18 +5,106 @@ __email__ = "eli.kaplan@alumni.ubc.ca"
 __license__ = "CC0 - No rights reserved. See LICENSE"
 
 import csv
+import io
+import locale
+import mmap
+import os
+import pickle
+import re
 import sys
 
 
-def loadPathwayInfoFromFile(filename, csv_separator):
+# Matches each frame ID in a pathway's ORFS column (e.g. O_7_7 and O_164_9 in [O_7_7,O_164_9]) - anything other than brackets, commas, and whitespace
+ORF_ID_PATTERN = re.compile(r'[^,\[\]()\s]+')
+
+# Suffix for cache files, which store a pickled copy of the parsed contents of an input file alongside it (e.g. maxbin_44.pwy.txt -> maxbin_44.pwy.txt.pkl)
+CACHE_FILE_SUFFIX = '.pkl'
+
+# Version of the layout of the cached data - bump this whenever the parsed data structures change, so that cache files written by older versions are ignored
+CACHE_FORMAT_VERSION = 1
+
+
+def loadCachedData(filename, cache_key):
+	""" loadCachedData(): Loads the previously parsed contents of an input file from its cache file, if there is one and it is still up to date
+
+						  Parameters:
+						  - filename: name of the input file whose parsed contents were cached
+						  - cache_key: tuple of the parameters the input file was parsed with (e.g. the CSV separator) - the cached data is only used if these match
+
+						  Returns: the cached data, or None if there is no usable cache file (missing, older than the input file, unreadable, written by a different CACHE_FORMAT_VERSION, or parsed with different parameters) """
+
+	cache_filename = filename + CACHE_FILE_SUFFIX
+
+	try:
+		# Don't use the cache file if the input file has been modified since the cache file was written
+		if os.path.getmtime(cache_filename) < os.path.getmtime(filename):
+			return None
+
+		with open(cache_filename, 'rb') as cache_file:
+			(cached_key, cached_data) = pickle.load(cache_file)
+
+	except Exception: # If the cache file doesn't exist or can't be read, just fall back to parsing the input file
+		return None
+
+	# Don't use the cached data if it was parsed with different parameters, or stored in a different format
+	if cached_key != (CACHE_FORMAT_VERSION, cache_key):
+		return None
+
+	return cached_data
+
+
+
+
+def storeCachedData(filename, cache_key, data):
+	""" storeCachedData(): Stores the parsed contents of an input file in its cache file, for loadCachedData() to reuse on later runs
+
+						   Parameters:
+						   - filename: name of the input file that was parsed
+						   - cache_key: tuple of the parameters the input file was parsed with (e.g. the CSV separator)
+						   - data: the parsed contents of the input file
+
+						   Returns: nothing - writes the cache file (filename + CACHE_FILE_SUFFIX) """
+
+	cache_filename = filename + CACHE_FILE_SUFFIX
+
+	# Write to a temporary file first and then move it into place, so that an interrupted write (or another process storing the same file) never leaves a partial cache file behind
+	tmp_cache_filename = cache_filename + '.' + str(os.getpid()) + '.tmp'
+
+	try:
+		with open(tmp_cache_filename, 'wb') as cache_file:
+			pickle.dump(((CACHE_FORMAT_VERSION, cache_key), data), cache_file, protocol=pickle.HIGHEST_PROTOCOL)
+
+		os.replace(tmp_cache_filename, cache_filename)
+
+	except Exception as e: # Failing to write the cache file isn't fatal - the input file will simply be parsed again next time
+		print("Could not write cache file for " + filename + ": " + str(e))
+
+		try:
+			os.remove(tmp_cache_filename)
+		except OSError:
+			pass
+
+
+
+
+def loadPathwayInfoFromFile(filename, csv_separator, use_cache=False):
 	""" loadPathwayInfoFromFile(): Loads pathway information from given filename (with given CSV separator character)
 
 								   Parameters: 
 								   - filename: name of file to load pathway information from (string)
 								   - csv_separator: CSV separator character (e.g. '\t')
+								   - use_cache: whether to reuse (and store) the parsed pathway information in a cache file alongside the pathway information file
 
 									Returns: Tuple(String(Sample Name), List(Tuple(Pathway Short Name, Pathway Common Name, List(Pathway ORF IDs))))) """
 
+	# If caching is enabled and this file has already been parsed, reuse the cached pathway information
+	if use_cache:
+		cached_data = loadCachedData(filename, (csv_separator,))
+		if cached_data is not None:
+			# Unpickled strings are not interned - intern the pathway names and ORF IDs again, as for freshly parsed pathway information
+			(sample_name, pathway_info) = cached_data
+			return (sample_name, [(sys.intern(pwy_name), pwy_cname, list(map(sys.intern, pwy_refs))) for (pwy_name, pwy_cname, pwy_refs) in pathway_info])
+
 
 	# List to place loaded pathway info into
 	pathway_info = []
@@ -27,7 +115,14 @@ def loadPathwayInfoFromFile(filename, csv_separator):
 	# Load the pathway information from the specified file
 	try:
 		with open(filename, 'r') as pwy_file:
-			pwy_reader = csv.reader(pwy_file, delimiter=csv_separator)
+			pwy_text = pwy_file.read()
+
+			# Tab-separated files with no quote characters in them are plain tables - split each line on the separator directly, as csv.reader's per-character tokenizing is unnecessary
+			# Anything else goes through csv.reader (e.g. in comma-separated files, the ORFS column and any common name containing a comma are quoted)
+			if csv_separator == '\t' and '"' not in pwy_text:
+				pwy_reader = (line.rstrip('\n').split(csv_separator) for line in io.StringIO(pwy_text))
+			else:
+				pwy_reader = csv.reader(io.StringIO(pwy_text), delimiter=csv_separator)
 
 			headerProcessed = False # Keep track of whether the file header has been processed
 			
@@ -59,12 +154,12 @@ def loadPathwayInfoFromFile(filename, csv_separator):
 				if sample_name == "": # Acquire the sample name if it is not yet set
 					sample_name = row[idx_sample]
 
-				pwy_name_str = row[idx_name] 	# PWY_NAME column
+				pwy_name_str = sys.intern(row[idx_name]) 	# PWY_NAME column (interned, as the same pathway names recur across samples)
 				pwy_cname_str = row[idx_cname] 	# PWY_COMMON_NAME column
 				pwy_refs_str = row[idx_orfs] 	# ORFS column
 				
-				# Parse the ORFS column into a list of frame IDs
-				pwy_refs_list = pwy_refs_str[1:-1].split(',')
+				# Parse the ORFS column into a list of frame IDs (interned, so that they are shared between pathways and match the RPKM data keys by identity)
+				pwy_refs_list = list(map(sys.intern, ORF_ID_PATTERN.findall(pwy_refs_str)))
 
 				# Store the parsed (NAME, COMMON_NAME, list(ORFS)) tuple
 				pathway_info.append((pwy_name_str, pwy_cname_str, pwy_refs_list))
@@ -74,79 +169,140 @@ def loadPathwayInfoFromFile(filename, csv_separator):
 		quit()
 
 
+	# Store the parsed pathway information for later runs, if caching is enabled
+	if use_cache:
+		storeCachedData(filename, (csv_separator,), (sample_name, pathway_info))
+
 	# Return the pathway information as a tuple of (Sample Name, list(tuple(Pathway Short Name, Pathway Common Name, list(ORF IDs))
 	return (sample_name, pathway_info)
 
 
 
 
-def loadORFDataFromFile(filename, sample_name, csv_separator):
+def loadORFDataFromFile(filename, sample_name, csv_separator, use_cache=False, parse_values=True):
 	""" loadORFDataFromFile: Loads ORF RPKM data for a set from a given file (with given sample name and csv separator)
 
 							 Parameters: 
 							 - filename: string containing ORF data file
 							 - sample_name: string containing name of sample (e.g. MaxBin_33)
 							 - csv_separator: string containing CSV separator character (e.g. '\t')
+							 - use_cache: whether to reuse (and store) the parsed RPKM data in a cache file alongside the RPKM data file
+							 - parse_values: whether to convert each RPKM reading to a float (every reading in the file must then be a valid number) - otherwise, each reading is kept exactly as written in the file
 
-							 Returns: Tuple(Sample Name, List(Tuple(ORF ID, RPKM Reading))) """
-	rpkm_data = []
+							 Returns: Tuple(Sample Name, Dict(ORF ID : RPKM Reading (float, or string if parse_values is False))) """
 
-	# Load the RPKM data from the specified file
-	try:
-		with open(filename, 'r') as data_file:
-			data_reader = csv.reader(data_file, delimiter=csv_separator)
+	# If caching is enabled and this file has already been parsed (for this sample), reuse the cached RPKM data
+	if use_cache:
+		cached_data = loadCachedData(filename, (sample_name, csv_separator, parse_values))
+		if cached_data is not None:
+			# Unpickled strings are not interned - intern the ORF IDs again, so they match the pathway ORF IDs by identity
+			return (cached_data[0], {sys.intern(data_id) : data_value for (data_id, data_value) in cached_data[1].items()})
 
-			for row in data_reader:
-				data_id = 'O_' + row[0].replace(sample_name,'')[1:] # Convert the frame ID column into the O_###_# format used in the pathway info file
-				data_value = row[1] 						 		# Capture the data point associated with this frame
+	rpkm_data = {}
 
-				# Store the parsed (ORF ID, Data) tuple
-				rpkm_data.append((data_id, data_value))
+	# Load the RPKM data from the specified file
+	try:
+		# The file is read as raw bytes, so decode the frame IDs with the same encoding open() uses for the other (text mode) input files
+		file_encoding = locale.getpreferredencoding(False)
+
+		# Frame IDs are formatted as [Sample Name]_###_## - strip that prefix with a single slice where possible
+		id_prefix = (sample_name + '_').encode(file_encoding)
+		id_prefix_len = len(id_prefix)
+
+		# The data file is a plain two-column table with no quoting - match the first two columns of each line (frame ID, data point) directly in the raw bytes of the file
+		separator = re.escape(csv_separator.encode())
+		row_pattern = re.compile(b'^([^' + separator + b'\r\n]+)' + separator + b'([^' + separator + b'\r\n]+)', re.MULTILINE)
+
+		with open(filename, 'rb') as data_file:
+			# Memory-map the file (empty files can't be mapped, but contain no data anyway), so that only the matched fields are ever copied into Python objects
+			if os.fstat(data_file.fileno()).st_size > 0:
+				with mmap.mmap(data_file.fileno(), 0, access=mmap.ACCESS_READ) as data_map:
+					for row_match in row_pattern.finditer(data_map):
+						frame_id = row_match.group(1) # Frame ID column (e.g. MaxBin_33_145_2)
+
+						# Convert the frame ID column into the O_###_# format used in the pathway info file (interned, so it matches the pathway ORF IDs by identity)
+						if frame_id.startswith(id_prefix):
+							data_id = sys.intern('O_' + frame_id[id_prefix_len:].decode(file_encoding))
+						else:
+							data_id = sys.intern('O_' + frame_id.decode(file_encoding).replace(sample_name,'')[1:])
+
+						# Store the data point associated with this frame (as a float, or as written in the file)
+						if parse_values:
+							rpkm_data[data_id] = float(row_match.group(2))
+						else:
+							rpkm_data[data_id] = row_match.group(2).decode(file_encoding)
 
 	except: # If an error occurred while loading / parsing the RPKM data file, exit.
 		print("ERROR: Could not read/parse RPKM data file - exiting.")
 		quit()
 
+	# Store the parsed RPKM data for later runs, if caching is enabled
+	if use_cache:
+		storeCachedData(filename, (sample_name, csv_separator, parse_values), (sample_name, rpkm_data))
+
 	# Return a tuple of the sample name and the loaded per-ORF RPKM reading data
 	return (sample_name, rpkm_data)
 
 
 
 
-def correlatePathwayInfoWithData(sample_name, pathway_info, rpkm_data):
+def correlatePathwayInfoWithData(sample_name, pathway_info, rpkm_data, missing_summaries=None):
 	""" correlatePathwayInfoWtihData: Correlates pathway info and experimental RPKM readings (summing the RPKM readings for each associated ORF) for one sample.
 
 									  Parameters:
 									  - sample_name: name of the sample (string)
 									  - pathway_info: list of tuples of the following format: (Pathway Short Name, Pathway Common Name, List(ORF IDs as strings))
-									  - rpkm_data: list of tuples formatted as: (ORF ID as string, RPKM reading as string (of float))
+									  - rpkm_data: dict of RPKM readings (as floats) keyed by ORF ID (as returned by loadORFDataFromFile())
+									  - missing_summaries: optional list - if given, the summary line for any missing data points is appended to it instead of being printed (e.g. so that it can be printed from the main process when this runs in a worker process)
 
 
 									  Returns: Tuple(Sample Name, List(Tuple(Pathway Short Name, Pathway Common Name, RPKM Readings Sum)))"""
 
 	# Correlate the data points in pathway_data with the IDs in pathway_info
 	pathway_sums = []
-	pathway_data_dict = dict(rpkm_data) # Convert the list of id/data tuples to a dict to make searching easier
+	pathway_data_dict = rpkm_data # RPKM readings (already floats), keyed by ORF ID
+	get_data_point = pathway_data_dict.get # Bind the lookup once, rather than resolving it for every pathway in the loop below
+
+	# Keep track of the number of missing data points (and the first few missing ORF IDs), to summarize once at the end rather than reporting each one
+	n_missing_data_points = 0
+	missing_refs = []
 
 	# Iterate through the pathways and sum up the ORF data points associated with each ID in the ORFS column
 	for pathway in pathway_info:
-		pwy_sum = 0.0
-		for ref in pathway[2]: # Add the data value associated with each ORF ID to pwy_sum (if it exists)
-			if ref in pathway_data_dict:
-				pwy_sum += float(pathway_data_dict[ref])
-			else:
-				print('Missing data point: ' + ref)
+		# Gather the data point for every ORF ID in this pathway in a single pass (None where the data point is missing)
+		data_points = list(map(get_data_point, pathway[2]))
+
+		# Count any ORF IDs that have no corresponding data point
+		n_pathway_missing = data_points.count(None)
+		if n_pathway_missing > 0:
+			n_missing_data_points += n_pathway_missing
+
+			# Hold on to the first 10 missing ORF IDs as examples for the report
+			if len(missing_refs) < 10:
+				missing_refs.extend(ref for ref, data_point in zip(pathway[2], data_points) if data_point is None)
+
+		# Sum up the gathered data points (filter() skips the missing ones - and zeroes, which don't change the sum)
+		pwy_sum = sum(filter(None, data_points), 0.0)
 
 		# Store the resulting tuple (PWY_NAME, PWY_COMMON_NAME, sum of referenced data points)
 		pathway_sums.append((pathway[0], pathway[1], pwy_sum))
 
+	# Report the missing data points (if any) in a single summary line - or hand it back to the caller, if a list was given for it
+	if n_missing_data_points > 0:
+		missing_summary = 'Missing ' + str(n_missing_data_points) + ' data points for sample ' + sample_name + ' (e.g. ' + ', '.join(missing_refs[:10]) + ')'
+
+		if missing_summaries is not None:
+			missing_summaries.append(missing_summary)
+		else:
+			print(missing_summary)
+
 	# Return a tuple of the sample name and the resulting data
 	return (sample_name, pathway_sums)
 
 
 
 
-def correlateRPKM(pwy_filename, data_filename, output_filename = 'pwy_data.tsv', csv_separator='\t'):
+def correlateRPKM(pwy_filename, data_filename, output_filename = 'pwy_data.tsv', csv_separator='\t', use_cache=False):
 	""" correlateRPKM(): Takes pathway information (from pwy_filename) and experimental ORF RPKM measurements (from data_filename) and correlates them,
 						 summing up RPKM measurements for each pathway by matching ORF IDs between pathways and the RPKM data file. This resulting data 
 						 is then output to a file with the specified name (output_filename), which defaults to pwy_data.tsv 
@@ -156,12 +312,13 @@ def correlateRPKM(pwy_filename, data_filename, output_filename = 'pwy_data.tsv',
 						 - data_filename: filename of the file containing the RPKM data for each ORF ID
 						 - output_filename: file for the results to be stored in
 						 - csv_separator: separator in use in the CSV files (e.g. '\t') 
+						 - use_cache: whether to cache the parsed input files alongside them (as <input file>.pkl), so that unchanged files don't need to be parsed again on later runs
 
 						 Returns: nothing - outputs results to specified file.""" 
 
 	
 	# Load the pathway information from the given file
-	pwy_info_file_data = loadPathwayInfoFromFile(pwy_filename, csv_separator)
+	pwy_info_file_data = loadPathwayInfoFromFile(pwy_filename, csv_separator, use_cache)
 	sample_name = pwy_info_file_data[0] # Name of the sample (E.g. MaxBin_33)
 	pathway_info = pwy_info_file_data[1] # List of tuples containing pathway info (short name, common name, list of ORF IDs)
 
@@ -169,7 +326,7 @@ def correlateRPKM(pwy_filename, data_filename, output_filename = 'pwy_data.tsv',
 
 
 	# Load the ORF RPKM data from the given file
-	pwy_orf_file_data = loadORFDataFromFile(data_filename, sample_name, csv_separator)
+	pwy_orf_file_data = loadORFDataFromFile(data_filename, sample_name, csv_separator, use_cache)
 	pathway_data = pwy_orf_file_data[1]
 
 	print("Loaded RPKM data for " + sample_name + " from " + data_filename)
@@ -182,11 +339,11 @@ def correlateRPKM(pwy_filename, data_filename, output_filename = 'pwy_data.tsv',
 
 	# Output the resulting data to the specified file
 	try:
-		with open(output_filename, 'w') as output_file:
+		with open(output_filename, 'w', newline='', buffering=1<<20) as output_file:
 			output_writer = csv.writer(output_file, delimiter=csv_separator)
 
-			for pair in pathway_sums:
-				output_writer.writerow(pair)
+			# Write out every row in a single call, rather than one row at a time (csv.writer quotes any field containing the separator, e.g. a common name containing a comma in a comma-separated file)
+			output_writer.writerows(pathway_sums)
 	
 	except: # If an error occurred while writing out the results, exit.
 		print("ERORR: File output failed - exiting.")
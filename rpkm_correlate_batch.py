@@ -7,12 +7,38 @@ __license__ = "CC0 - No rights reserved. See LICENSE"
 import csv
 import sys
 
-from os import listdir
-from os.path import join
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from os import scandir
 
-from rpkm_correlate import loadPathwayInfoFromFile, loadORFDataFromFile, correlatePathwayInfoWithData
+from rpkm_correlate import loadPathwayInfoFromFile, loadORFDataFromFile, correlatePathwayInfoWithData, CACHE_FILE_SUFFIX
 
-def batchCorrelateRPKM(file_dir, output_filename = 'pwy_data_batch.tsv', csv_separator='\t', pwy_file_suffix='.pwy.txt', data_file_suffix='.orf_rpkm.txt', excl_zeroes=False, stats_file_suffix='_stats', separate_stats = True):
+def correlateSampleFiles(pathway_file, data_file, csv_separator='\t', use_cache=False):
+	""" correlateSampleFiles(): Loads a single sample's pathway information file and corresponding RPKM data file, and correlates each pathway with its respective data points
+
+							    Parameters:
+							    - pathway_file: name of the file containing pathway information for this sample
+							    - data_file: name of the file containing RPKM data for this sample
+							    - csv_separator: column separator used in given files
+							    - use_cache: whether to reuse (and store) the parsed contents of the given files in cache files alongside them
+
+							    Returns: Tuple(Sample Name, List(Tuple(Pathway Short Name, Pathway Common Name, RPKM Readings Sum)), List(Missing Data Points Summary Lines)) - the summary (from correlatePathwayInfoWithData()) is returned rather than printed, for the caller to print """
+
+	# Load pathway information from the given file
+	pathway_info = loadPathwayInfoFromFile(pathway_file, csv_separator, use_cache)
+	cur_sample = pathway_info[0]
+
+	# Load RPKM data from the file corresponding to the pathway info file
+	rpkm_data = loadORFDataFromFile(data_file, cur_sample, csv_separator, use_cache)
+
+	# Correlate the data from the two files, collecting the summary of any missing data points rather than printing it here
+	missing_summaries = []
+	corr_pwy_data = correlatePathwayInfoWithData(cur_sample, pathway_info[1], rpkm_data[1], missing_summaries)
+
+	return (corr_pwy_data[0], corr_pwy_data[1], missing_summaries)
+
+
+def batchCorrelateRPKM(file_dir, output_filename = 'pwy_data_batch.tsv', csv_separator='\t', pwy_file_suffix='.pwy.txt', data_file_suffix='.orf_rpkm.txt', excl_zeroes=False, stats_file_suffix='_stats', separate_stats = True, use_cache=False, n_workers=None):
 	""" batchCorrelateRPKM(): Takes a directory with two sets of files (one set of files containing pathway information and assocated ORF RPKM data IDs, and the
 							  other containing ORF IDs and associated data points), sums the RPKM data for each pathway within a sample, and combines all of the sample results
 							  into a single file.
@@ -24,31 +50,34 @@ def batchCorrelateRPKM(file_dir, output_filename = 'pwy_data_batch.tsv', csv_sep
 							  - pwy_file_suffix: suffix for files containing pathway information
 							  - data_file_suffix: suffix for files containing RPKM data 
 							  - excl_zeroes: whether average calculations should exclude zero-values (i.e. pathways not found in specific samples)
+							  - use_cache: whether to reuse (and store) the parsed contents of each input file in a cache file alongside it (see loadCachedData() in rpkm_correlate)
+							  - n_workers: number of worker processes to load samples with (defaults to one per CPU core - using more can help when reading from slow or network storage)
 
 							  Returns: nothing - outputs results to specified file"""
 
-	# Create a list of all files in the target directory
-	all_files = [join(file_dir, f) for f in listdir(file_dir)]
-
-	# Split the list of all the files into two lists: a list of pathway information files, and a list of RPKM data files
+	# Split the files in the target directory into two groups: a list of pathway information files, and a set of RPKM data files (for quick lookups when pairing them up below)
 	pwy_files = []
-	data_files = []
+	data_files = set()
 
-	for file in all_files:
-		if pwy_file_suffix in file:
-			pwy_files.append(file)
-		elif data_file_suffix in file:
-			data_files.append(file)
-		else:
-			print("Unknown file in batch directory: " + file)
+	# Sort each file by the suffix at the end of its name (so e.g. a stray 'maxbin_1.pwy.txt.bak' is not mistaken for a pathway file)
+	with scandir(file_dir) as dir_entries:
+		for entry in dir_entries:
+			if entry.name.endswith(pwy_file_suffix):
+				pwy_files.append(entry.path)
+			elif entry.name.endswith(data_file_suffix):
+				data_files.add(entry.path)
+			elif entry.name.endswith(pwy_file_suffix + CACHE_FILE_SUFFIX) or entry.name.endswith(data_file_suffix + CACHE_FILE_SUFFIX):
+				pass # Cache files are written alongside the input files when they are loaded with use_cache - these are expected, not unknown (any other .pkl file still is)
+			else:
+				print("Unknown file in batch directory: " + entry.path)
 
 
 	# Match each pathway information file with its corresponding RPKM data file (assuming they have the same sample name)
 	file_pairs = []
 
 	for pwy_file in pwy_files:
-		# Generate the name of the corresponding data file based on the name of the pathway info file
-		corresponding_data_file = pwy_file.replace(pwy_file_suffix, data_file_suffix)
+		# Generate the name of the corresponding data file based on the name of the pathway info file, swapping out only the suffix at the end of the name (any other occurrence of the suffix in the path is left alone)
+		corresponding_data_file = pwy_file[:-len(pwy_file_suffix)] + data_file_suffix
 	
 		# If this file exists, pair it with the pathway file
 		if corresponding_data_file in data_files:
@@ -59,139 +88,123 @@ def batchCorrelateRPKM(file_dir, output_filename = 'pwy_data_batch.tsv', csv_sep
 			print("Missing ORF data file: " + corresponding_data_file)
 
 
-	# Load/parse each pathway information file and corresponding data file, then correlate each pathway with its respective data points
-	all_files_data = []
-
-	for (pathway_file, data_file) in file_pairs:
-		# Load pathway information from the given file
-		pathway_info = loadPathwayInfoFromFile(pathway_file, csv_separator)
-		cur_sample = pathway_info[0]
+	# Create a dict containing all of the loaded data, keyed by pathway short-name (such as to allow per-sample data to be accessed for each pathway)
+	per_pathway_data = dict()
 
-		# Load RPKM data from the file corresponding to the pathway info file
-		rpkm_data = loadORFDataFromFile(data_file, cur_sample, csv_separator)
+	# Keep track of all of the samples encountered, and assign each one a column (in the order they are loaded) in the per-pathway data
+	sample_columns = dict()
 
-		# Correlate the data from the two files
-		corr_pwy_data = correlatePathwayInfoWithData(cur_sample, pathway_info[1], rpkm_data[1])
+	# Load/parse each pathway information file and corresponding data file, then correlate each pathway with its respective data points
+	# The samples are independent of each other, so they are loaded in parallel worker processes - results are returned in the same order as file_pairs
+	with ProcessPoolExecutor(max_workers=n_workers) as executor:
+		sample_results = executor.map(partial(correlateSampleFiles, csv_separator=csv_separator, use_cache=use_cache), *zip(*file_pairs))
 
-		# Store this correlated data (tuple of (Sample Name, Data)) in all_files_data
-		all_files_data.append(corr_pwy_data)
+		# Add each pathway from each sample to per_pathway_data as soon as the sample has been loaded (rather than holding every sample's results in memory until all of them are loaded)
+		for (sample, pathways, missing_summaries) in sample_results:
+			sample_column = sample_columns.setdefault(sys.intern(sample), len(sample_columns))
 
-		print("Loaded data for sample: " + cur_sample)				
+			# Report progress (and any missing data points) from the main process (in file order), rather than having every worker process compete for the console
+			for missing_summary in missing_summaries:
+				print(missing_summary)
 
+			print("Loaded data for sample: " + sample)
 
-	# Create a dict containing all of this previously loaded data, keyed by pathway short-name (such as to allow per-sample data to be accessed for each pathway)
-	per_pathway_data = dict()
-	all_samples = [] # Keep track of all of the samples encountered
+			for pwy in pathways:
+				pwy_name = sys.intern(pwy[0]) # Short name for this pathway (interned, as each sample's results arrive from a worker process with their own copy of every name)
+				pwy_cname = pwy[1] # Common name for this pathway
+				pwy_rpkm = pwy[2] # Sum of RPKM readings for this pathway for this sample
 
-	# Add each pathway from each sample to per_pathway_data
-	for (sample, pathways) in all_files_data:
-		for pwy in pathways:
-			pwy_name = pwy[0] # Short name for this pathway
-			pwy_cname = pwy[1] # Common name for this pathway
-			pwy_rpkm = pwy[2] # Sum of RPKM readings for this pathway for this sample
+				# If the pathway is not in the dict yet, add it.
+				# The list field contains the RPKM sum for each sample, by column - it is only extended as far as the last sample the pathway was measured in, so any missing readings (including at the end) are 0.0
+				pwy_data = per_pathway_data.get(pwy_name)
+				if pwy_data is None:
+					pwy_data = per_pathway_data[pwy_name] = [pwy_name, pwy_cname, []]
 
-			# If the pathway is not in the dict yet, add it.
-			if pwy_name not in per_pathway_data:
-				per_pathway_data[pwy_name] = [pwy_name, pwy_cname, dict()] # the dict() field will contain {'Sample Name' : 'RPKM Sum'} data for each pathway
-			
-			# Append the data for this current sample to the data for this pathway
-			per_pathway_data[pwy_name][2][sample] = pwy_rpkm
+				# Store the data for this current sample in this sample's column for this pathway, padding out any samples it was not measured in with 0.0
+				pwy_readings = pwy_data[2]
+				if len(pwy_readings) <= sample_column:
+					pwy_readings.extend([0.0] * (sample_column + 1 - len(pwy_readings)))
+				pwy_readings[sample_column] = pwy_rpkm
 
-		# Add this sample to the list of samples encountered
-		all_samples.append(sample)
 
+	# Put all of the samples encountered in sorted order, and find the column each one's readings are stored in
+	all_samples = sorted(sample_columns)
+	sorted_sample_columns = [sample_columns[sample] for sample in all_samples]
+	n_samples = len(all_samples)
 
-	# For each pathway, if said pathway is not measured in one of the samples, assign a RPKM sum value of 0.0 for that sample 
-	for pathway, data in per_pathway_data.items():
-		for sample in all_samples:
-			if sample not in data[2]:
-				data[2][sample] = 0.0
+	# Pad out each pathway's readings with 0.0 for any samples loaded after it was last measured, and put them in the same order as all_samples - every pathway then has a reading (possibly 0.0) for each sample
+	for data in per_pathway_data.values():
+		pwy_readings = data[2]
+		pwy_readings.extend([0.0] * (n_samples - len(pwy_readings)))
+		data[2] = [pwy_readings[column] for column in sorted_sample_columns]
 
 	
 	# Generate a header for the output tabulated file 
 	output_file_header = ['Name', 'Common Name', 'Average RPKM', 'RPKM Sum', 'In # Samples']
-	for sample in sorted(all_samples):
+	for sample in all_samples:
 		output_file_header.append(sample)
 
 
-	# Keep track of the per-sample RPKM sums and numbers of non-zero values as {'Sample Name' : #}
-	sample_col_sums = {}
-	sample_col_nonzero_values = {}
+	# Generate the output row for each pathway (as the rows are written out)
+	def generatePathwayRows():
+		for pathway, data in per_pathway_data.items():
+			# Add the pathway short-name and common-name to the current row to be written
+			row = [data[0], data[1]]
+			pwy_readings = data[2]
 
-	# Output the resulting data to the chosen file
-	try:
-		with open(output_filename, 'w') as output_file:
-			output_writer = csv.writer(output_file, delimiter=csv_separator)
-
-			# Write the header to the output file as the first line.
-			output_writer.writerow(output_file_header)
+			# Calculate the per-pathway RPKM value sum across all of the samples, and the number of samples this pathway appears in (i.e. has a non-zero reading in) - sum() and count() each run over the readings in C, rather than adding them up one at a time in Python
+			rpkm_sum = sum(pwy_readings, 0.0)
+			in_n_samples = n_samples - pwy_readings.count(0.0)
 
 
-			# Write out the data for each pathway
-			for pathway, data in per_pathway_data.items():
-				# Add the pathway short-name and common-name to the current row to be written
-				row = [data[0], data[1]]
+			# Calculate the per-pathway RPKM value average
+			rpkm_average = 0
 
-				# Calculate the per-pathway RPKM value sum across all of the samples
-				rpkm_sum = sum(data[2].values())
+			# Only perform this calculation for pathways that have been measured in at least one sample
+			if rpkm_sum > 0.0:
 
+				# If zero-values are to be excluded, calculate the average as (sum) / (number of samples where this pathway has been identified)
+				if excl_zeroes == True:
+					if in_n_samples != 0:
+						rpkm_average = rpkm_sum / in_n_samples
 
-				# Calculate the per-pathway RPKM value average
-				rpkm_average = 0
-
-				# Only perform this calculation for pathways that have been measured in at least one sample
-				if rpkm_sum > 0.0:
+				# Otherwise, just use the total number of samples to calculate the average
+				else:
+					rpkm_average = rpkm_sum / n_samples
 
-					# If zero-values are to be excluded, calculate the number of samples this pathway was measured in
-					if excl_zeroes == True:
-						num_nonzero_samples = 0
-						for sample_reading in data[2].values():
-							if sample_reading != 0.0:
-								num_nonzero_samples += 1
-						
-						# Calculate the average as (sum) / (number of samples where this pathway has been identified)
-						if num_nonzero_samples != 0:
-							rpkm_average = rpkm_sum / num_nonzero_samples
+			# Append the per-pathway RPKM average and sum to the row
+			row.append(rpkm_average)
+			row.append(rpkm_sum)
 
-					# Otherwise, just use the total number of samples to calculate the average
-					else:
-						rpkm_average = rpkm_sum / len(data[2].values())
+			# Append the fraction of samples that the pathway appears in to the current row to be written 
+			row.append(str(in_n_samples) + '/' + str(n_samples))
 
-				# Append the per-pathway RPKM average and sum to the row
-				row.append(rpkm_average)
-				row.append(rpkm_sum)
+			# Append the RPKM reading for this pathway in each sample to the row to be written out (in the same order as all_samples)
+			row.extend(pwy_readings)
 
-				# Calculate fraction of samples that the pathway appears in
-				in_n_samples = 0
-				for sample, val in data[2].items():
-					if val != 0.0:
-						in_n_samples += 1
+			# Hand the current row over to be written to the output file
+			yield row
 
-				# Append this to the current row to be written 
-				row.append(str(in_n_samples) + '/' + str(len(all_samples)))
 
-				# Iterate over all of the {'Sample' : 'RPKM Sum'} data for this pathway
-				for sample, val in sorted(data[2].items()):
+	# Output the resulting data to the chosen file
+	try:
+		with open(output_filename, 'w', newline='', buffering=1<<20) as output_file:
+			output_writer = csv.writer(output_file, delimiter=csv_separator)
 
-					# Add the reading for this pathway in each sample to the dict of per-sample total RPKM sums
-					if sample in sample_col_sums.keys():
-						sample_col_sums[sample] += val
-					else:
-						sample_col_sums[sample] = val
+			# Write the header to the output file as the first line.
+			output_writer.writerow(output_file_header)
 
-					# If the reading for this pathway is non-zero, add it to the dict of per-sample number of non-zero-RPKM pathways (i.e. unique pathways found in each sample)
-					if val != 0.0:
-						if sample in sample_col_nonzero_values.keys():
-							sample_col_nonzero_values[sample] += 1
-						else:
-							sample_col_nonzero_values[sample] = 1
+			# Write out the data for each pathway
+			output_writer.writerows(generatePathwayRows())
 
 
-					# Append the RPKM reading for this pathway in this sample to the row to be written out 
-					row.append(val)
+			# Calculate the per-sample RPKM sums and numbers of non-zero values (i.e. unique pathways found in each sample) as {'Sample Name' : #}, from each sample's column of readings across all of the pathways
+			sample_col_sums = {}
+			sample_col_nonzero_values = {}
 
-				# Write the current row to the output file
-				output_writer.writerow(row)
+			for sample, sample_readings in zip(all_samples, zip(*(data[2] for data in per_pathway_data.values()))):
+				sample_col_sums[sample] = sum(sample_readings, 0.0)
+				sample_col_nonzero_values[sample] = len(sample_readings) - sample_readings.count(0.0)
 
 
 			# If per-sample stats are not specified to be separated, place them in the bottom of the output file
@@ -199,7 +212,7 @@ def batchCorrelateRPKM(file_dir, output_filename = 'pwy_data_batch.tsv', csv_sep
 				# Add a row for the total per-sample RPKM sums to the bottom of the file
 				sums_row = ['SAMPLE-SUMS', 'Per-Sample RPKM Sum', '--', '--', '--']	
 
-				for sample, total_sum in sorted(sample_col_sums.items()):
+				for sample, total_sum in sample_col_sums.items():
 					sums_row.append(total_sum)
 
 				output_writer.writerow(sums_row)
@@ -212,12 +225,12 @@ def batchCorrelateRPKM(file_dir, output_filename = 'pwy_data_batch.tsv', csv_sep
 
 				# If zeroes are excluded, calculate this average as (per-sample RPKM sum) / (per-sample number of unique pathways observed with non-zero RPKM)
 				if excl_zeroes == True:
-					for sample, total_sum in sorted(sample_col_sums.items()):
+					for sample, total_sum in sample_col_sums.items():
 						averages_row.append(total_sum / sample_col_nonzero_values[sample])
 
 				# Otherwise, calculate as (per-sample RPKM sum) / (total number of pathways loaded from all files)
 				else:
-					for sample, total_sum in sorted(sample_col_sums.items()):
+					for sample, total_sum in sample_col_sums.items():
 						averages_row.append(total_sum / total_num_pathways)
 
 				output_writer.writerow(averages_row)
@@ -225,7 +238,7 @@ def batchCorrelateRPKM(file_dir, output_filename = 'pwy_data_batch.tsv', csv_sep
 
 		# If the per-sample stats are supposed to be separated, create a new file for them and output them there.
 		if separate_stats == True:
-			with open(output_filename + stats_file_suffix, 'w') as output_stats_file:
+			with open(output_filename + stats_file_suffix, 'w', newline='', buffering=1<<20) as output_stats_file:
 				stats_writer = csv.writer(output_stats_file, delimiter=csv_separator)
 
 				# Write out the header for this file
@@ -233,21 +246,16 @@ def batchCorrelateRPKM(file_dir, output_filename = 'pwy_data_batch.tsv', csv_sep
 				stats_writer.writerow(stats_header)
 
 				# Write out a statistics row for each sample
-				for sample, total_sum in sample_col_sums.items():
-					cur_row = [sample, total_sum]
-
-					if excl_zeroes == True:
-						cur_row.append(total_sum / sample_col_nonzero_values[sample])
-
-					else:
-						total_num_pathways = len(per_pathway_data.keys())
-						cur_row.append(total_sum / total_num_pathways)
+				if excl_zeroes == True:
+					stats_writer.writerows([sample, total_sum, total_sum / sample_col_nonzero_values[sample]] for sample, total_sum in sample_col_sums.items())
 
-					stats_writer.writerow(cur_row)
+				else:
+					total_num_pathways = len(per_pathway_data.keys())
+					stats_writer.writerows([sample, total_sum, total_sum / total_num_pathways] for sample, total_sum in sample_col_sums.items())
 
 
 	
-	except Exception as e: # If an error occurred while writing out the results, exit.
+	except OSError as e: # If the output files could not be opened or written to, exit.
 		print("ERORR: File output failed - exiting.")
 		print("Exception: " + str(e))
 		quit()